@@ -1,13 +1,19 @@
+import atexit
 import streamlit as st
 import pandas as pd
 import re
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from io import BytesIO
 import zipfile
 import requests
+from requests.adapters import HTTPAdapter, Retry
 from pathlib import Path
+import shutil
+import subprocess
 import tempfile
 import os
 
+from PIL import Image, ImageOps
 from docxtpl import DocxTemplate, InlineImage
 from docx.shared import Inches
 from docx.image.exceptions import UnrecognizedImageError
@@ -16,6 +22,45 @@ from docx2pdf import convert
 
 # ---------- GOOGLE SHEET CSV LOADER ----------
 
+_SHEET_ID_RE = re.compile(r"/spreadsheets/d/([a-zA-Z0-9-_]+)")
+
+# Only these columns are used downstream; anything else in the sheet is
+# skipped at parse time.
+REQUIRED_COLUMNS = frozenset({
+    "Date",
+    "Time",
+    "Site Name",
+    "Images",
+    "Documentation Check [Attendance Register]",
+    "Documentation Check [Handling / Taking Over Register]",
+    "Documentation Check [Visitor Log Register]",
+    "Performance Check [Grooming]",
+    "Performance Check [Alertness]",
+    "Performance Check [Post Discipline]",
+    "Performance Check [Overall Rating]",
+    "Observation",
+    "Inspected By",
+})
+
+# Sheet headers → template context keys, applied once per batch so rows
+# can be plain dicts with identifier-style keys.
+COLUMN_MAP = {
+    "Site Name": "site_name_raw",
+    "Date": "date",
+    "Time": "time",
+    "Images": "images",
+    "Documentation Check [Attendance Register]": "attendance_register",
+    "Documentation Check [Handling / Taking Over Register]": "handling_register",
+    "Documentation Check [Visitor Log Register]": "material_register",
+    "Performance Check [Grooming]": "grooming",
+    "Performance Check [Alertness]": "alertness",
+    "Performance Check [Post Discipline]": "post_discipline",
+    "Performance Check [Overall Rating]": "overall_rating",
+    "Observation": "observation",
+    "Inspected By": "inspected_by",
+}
+
+
 def extract_sheet_id(sheet_input: str) -> str:
     """
     Accepts either:
@@ -25,48 +70,86 @@ def extract_sheet_id(sheet_input: str) -> str:
     Example URL:
     https://docs.google.com/spreadsheets/d/xxxxxxxxxxxxxxxxxxxxxxxxxxxx/edit#gid=0
     """
-    url_pattern = r"/spreadsheets/d/([a-zA-Z0-9-_]+)"
-    match = re.search(url_pattern, sheet_input)
+    match = _SHEET_ID_RE.search(sheet_input)
     if match:
         return match.group(1)
     return sheet_input.strip()
 
 
-def load_sheet_via_csv(sheet_input: str, gid: str | None = None) -> pd.DataFrame:
+def load_sheet_via_csv(sheet_input: str, gid: str | None = None,
+                       columns=REQUIRED_COLUMNS) -> pd.DataFrame:
     """
     Fetch Google Sheet as CSV using public export URL.
     Sheet must be shared as 'Anyone with link can view'.
+    Only the given columns are loaded, everything as plain strings
+    (no dtype inference, empty cells stay ""), which keeps memory down
+    and spares downstream code any NaN handling.
     """
     sheet_id = extract_sheet_id(sheet_input)
     base_url = f"https://docs.google.com/spreadsheets/d/{sheet_id}/export?format=csv"
     if gid:
         base_url += f"&gid={gid}"
-    df = pd.read_csv(base_url)
+    df = pd.read_csv(
+        base_url,
+        usecols=lambda c: c in columns,
+        dtype=str,
+        keep_default_na=False,
+    )
     return df
 
 
 # ---------- SITE NAME PARSER ----------
 
-def parse_site_name(raw: str):
+def add_site_name_columns(df_date: pd.DataFrame) -> pd.DataFrame:
     """
-    Input:  "4-361-Candid Manesar"
-    Output: zone='4', unit_code='361', site_name='Candid Manesar'
+    Split "4-361-Candid Manesar" style values into zone='4',
+    unit_code='361', site_name_clean='Candid Manesar' columns, plus a
+    filename-safe site_slug. Vectorized so the whole slice is parsed in
+    one pass instead of once per row.
     """
-    if not isinstance(raw, str):
-        return "", "", ""
+    if "Site Name" not in df_date.columns:
+        df_date["zone"] = ""
+        df_date["unit_code"] = ""
+        df_date["site_name_clean"] = ""
+        df_date["site_slug"] = "Site"
+        return df_date
+
+    raw = df_date["Site Name"].astype(str)
+    # reindex pads missing part-columns with NaN (float) when no value has
+    # the full shape — and on an empty slice every column is float — so
+    # force string dtype before touching the .str accessor.
+    split = raw.str.split("-", n=2, expand=True).reindex(columns=range(3))
+    split = split.fillna("").astype(str)
+
+    # Fallback: values without zone-unit-name shape keep the raw string as name
+    full = split[2] != ""
+    df_date["zone"] = split[0].str.strip().where(full, "")
+    df_date["unit_code"] = split[1].str.strip().where(full, "")
+    df_date["site_name_clean"] = split[2].str.strip().where(full, raw.str.strip())
+    df_date["site_slug"] = (
+        df_date["site_name_clean"].replace("", "Site").str.replace(" ", "_", regex=False)
+    )
+    return df_date
 
-    parts = raw.split("-", 2)  # split into max 3 parts
-    if len(parts) < 3:
-        # Fallback: treat whole string as site_name
-        return "", "", raw.strip()
 
-    zone = parts[0].strip()
-    unit_code = parts[1].strip()
-    sitename = parts[2].strip()
-    return zone, unit_code, sitename
+# ---------- GOOGLE DRIVE IMAGE DOWNLOADER ----------
 
+# Shared session so TCP connections / TLS handshakes are reused across downloads
+_SESSION = requests.Session()
+_SESSION.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=32,
+        pool_maxsize=32,
+        max_retries=Retry(total=2, backoff_factor=0.3),
+    ),
+)
+
+_DRIVE_ID_RES = (
+    re.compile(r"id=([A-Za-z0-9_-]+)"),
+    re.compile(r"/d/([A-Za-z0-9_-]+)/"),
+)
 
-# ---------- GOOGLE DRIVE IMAGE DOWNLOADER ----------
 
 def extract_drive_file_id(url: str) -> str:
     """
@@ -74,95 +157,148 @@ def extract_drive_file_id(url: str) -> str:
     - https://drive.google.com/open?id=FILEID
     - https://drive.google.com/file/d/FILEID/view
     """
-    patterns = [
-        r"id=([A-Za-z0-9_-]+)",
-        r"/d/([A-Za-z0-9_-]+)/",
-    ]
-    for p in patterns:
-        m = re.search(p, url)
+    for pattern in _DRIVE_ID_RES:
+        m = pattern.search(url)
         if m:
             return m.group(1)
     return ""
 
 
-def download_drive_image(url: str) -> BytesIO | None:
+# Photos render at ~2.5 inches, so anything beyond this is wasted pixels
+_IMG_MAX_PX = 600
+
+
+def _prepare_image(raw: bytes) -> bytes:
     """
-    Download an image from a Google Drive share link.
-    Returns BytesIO if content is a real image, otherwise None.
+    Downscale and recompress an image for document embedding. Drive photos
+    are often multi-MB originals; shrinking them to the display size keeps
+    the DOCX/PDF small and the Word conversion fast. Falls back to the
+    original bytes if Pillow can't decode them.
     """
-    file_id = extract_drive_file_id(url)
-    if not file_id:
-        return None
+    try:
+        img = Image.open(BytesIO(raw))
+        if img.width <= _IMG_MAX_PX and img.height <= _IMG_MAX_PX:
+            return raw
+        # Bake in the EXIF orientation tag first — re-encoding drops it,
+        # which would leave portrait phone photos rotated 90°
+        img = ImageOps.exif_transpose(img)
+        img.thumbnail((_IMG_MAX_PX, _IMG_MAX_PX), Image.LANCZOS)
+        if img.mode in ("RGBA", "LA", "P"):
+            # Flatten transparency onto white — JPEG would render it black
+            img = img.convert("RGBA")
+            background = Image.new("RGB", img.size, (255, 255, 255))
+            background.paste(img, mask=img.getchannel("A"))
+            img = background
+        out = BytesIO()
+        img.convert("RGB").save(out, format="JPEG", quality=80, optimize=True)
+        return out.getvalue()
+    except Exception:
+        return raw
+
+
+# Successful downloads only, keyed by Drive file id. Process-global, so
+# every Streamlit session shares it; failures are deliberately left out
+# so a transient timeout or quota page stays retryable on the next run.
+_IMAGE_CACHE: dict[str, bytes] = {}
+_IMAGE_CACHE_MAX = 256
+
+
+def _download_by_id(file_id: str) -> bytes | None:
+    """
+    Fetch the image bytes for a Drive file id, or None if the content is
+    not a real image. Successful downloads are cached process-wide so an
+    image shared between rows is only fetched once.
+    """
+    cached = _IMAGE_CACHE.get(file_id)
+    if cached is not None:
+        return cached
 
     download_url = f"https://drive.google.com/uc?export=download&id={file_id}"
 
     try:
-        resp = requests.get(download_url, timeout=15)
-        if resp.status_code == 200:
+        with _SESSION.get(download_url, timeout=15, stream=True) as resp:
+            if resp.status_code != 200:
+                return None
             content_type = resp.headers.get("Content-Type", "")
-            # Only accept real images
-            if content_type.startswith("image/"):
-                return BytesIO(resp.content)
+            # Only accept real images — bail before transferring the body
+            # when Drive answers with an HTML interstitial page instead
+            if not content_type.startswith("image/"):
+                return None
+            # Shrink before caching so the cache holds the small version
+            data = _prepare_image(resp.content)
     except Exception:
         return None
 
-    return None
+    if len(_IMAGE_CACHE) >= _IMAGE_CACHE_MAX:
+        # Evict the oldest entry (dicts keep insertion order)
+        _IMAGE_CACHE.pop(next(iter(_IMAGE_CACHE)), None)
+    _IMAGE_CACHE[file_id] = data
+    return data
+
+
+def download_drive_image(url: str) -> BytesIO | None:
+    """
+    Download an image from a Google Drive share link.
+    Returns BytesIO if content is a real image, otherwise None.
+    """
+    file_id = extract_drive_file_id(url)
+    if not file_id:
+        return None
+
+    raw = _download_by_id(file_id)
+    # Fresh BytesIO per use — the cached bytes are shared, a stream is not
+    return BytesIO(raw) if raw else None
 
 
 # ---------- WORD DOCX GENERATION ----------
 
-def render_docx_for_row(row: pd.Series, template_path: str) -> BytesIO:
+# Display width for embedded inspection photos
+_IMG_WIDTH = Inches(2.5)
+
+def render_docx_for_row(row: dict, template_bytes: bytes, out_path: str | None = None) -> BytesIO | str:
     """
-    Render template.docx for a single row and return BytesIO of the .docx file,
-    embedding images at the bottom.
+    Render the report template for a single row, embedding images at the
+    bottom. Takes a plain row dict (COLUMN_MAP keys, built once per batch)
+    and the raw template.docx bytes, so each row skips the disk open.
+    Saves to out_path and returns it when given, otherwise returns a
+    BytesIO of the .docx file.
     """
 
-    # Destructure site name
-    raw_site = row.get("Site Name", "")
-    zone, unit_code, site_name_clean = parse_site_name(raw_site)
-
     # Download & prepare images
-    images_raw = str(row.get("Images", "") or "").strip()
+    images_raw = str(row.get("images", "") or "").strip()
     image_objs: list[BytesIO] = []
     if images_raw:
         urls = [u.strip() for u in images_raw.split(",") if u.strip()]
-        for url in urls:
-            img_bytes = download_drive_image(url)
-            if img_bytes:
-                image_objs.append(img_bytes)
+        if urls:
+            # Fetches are network-bound, so download all URLs concurrently
+            with ThreadPoolExecutor(max_workers=min(16, len(urls))) as ex:
+                image_objs = [buf for buf in ex.map(download_drive_image, urls) if buf]
 
-    # Build context for template
+    # Build context for template (site name parts were split once in main)
     context = {
-        "zone": zone,
-        "unit_code": unit_code,
-        "site_name": site_name_clean,
-        "date": row.get("Date", ""),
-        "time": row.get("Time", ""),
-        "attendance_register": row.get("Documentation Check [Attendance Register]", ""),
-        "handling_register": row.get("Documentation Check [Handling / Taking Over Register]", ""),
-        "material_register": row.get("Documentation Check [Visitor Log Register]", ""),
-        "grooming": row.get("Performance Check [Grooming]", ""),
-        "alertness": row.get("Performance Check [Alertness]", ""),
-        "post_discipline": row.get("Performance Check [Post Discipline]", ""),
-        "overall_rating": row.get("Performance Check [Overall Rating]", ""),
-        "observation": row.get("Observation", ""),
-        "inspected_by": row.get("Inspected By", ""),
+        "zone": row.get("zone", ""),
+        "unit_code": row.get("unit_code", ""),
+        "site_name": row.get("site_name_clean", ""),
+        "date": row.get("date", ""),
+        "time": row.get("time", ""),
+        "attendance_register": row.get("attendance_register", ""),
+        "handling_register": row.get("handling_register", ""),
+        "material_register": row.get("material_register", ""),
+        "grooming": row.get("grooming", ""),
+        "alertness": row.get("alertness", ""),
+        "post_discipline": row.get("post_discipline", ""),
+        "overall_rating": row.get("overall_rating", ""),
+        "observation": row.get("observation", ""),
+        "inspected_by": row.get("inspected_by", ""),
     }
 
-    # Clean NaN / None
-    for k, v in list(context.items()):
-        if pd.isna(v):
-            context[k] = ""
-        elif v is None:
-            context[k] = ""
-
-    tpl = DocxTemplate(template_path)
+    tpl = DocxTemplate(BytesIO(template_bytes))
 
     # Create InlineImage list (can be empty; template uses {% for img in images %})
     images_inline = []
     for img in image_objs:
         try:
-            images_inline.append(InlineImage(tpl, img, width=Inches(2.5)))
+            images_inline.append(InlineImage(tpl, img, width=_IMG_WIDTH))
         except UnrecognizedImageError:
             # Skip invalid / non-image content silently
             continue
@@ -172,13 +308,66 @@ def render_docx_for_row(row: pd.Series, template_path: str) -> BytesIO:
     # Render the template
     tpl.render(context)
 
-    # Save to buffer
+    # Save directly to disk when a path is given, else to a buffer
+    if out_path:
+        tpl.save(out_path)
+        return out_path
+
     buf = BytesIO()
     tpl.save(buf)
     buf.seek(0)
     return buf
 
 
+def convert_batch(docx_dir: str) -> None:
+    """
+    Convert every .docx in docx_dir to a PDF alongside it. When soffice is
+    on PATH (Linux servers) the whole batch goes through one headless
+    LibreOffice invocation, paying the startup cost once; otherwise falls
+    back to docx2pdf's directory conversion (Word on Windows/macOS).
+    """
+    soffice = shutil.which("soffice")
+    if not soffice:
+        convert(docx_dir)
+        return
+
+    docx_paths = [
+        os.path.join(docx_dir, name)
+        for name in sorted(os.listdir(docx_dir))
+        if name.endswith(".docx")
+    ]
+    if not docx_paths:
+        return
+    subprocess.run(
+        [soffice, "--headless", "--convert-to", "pdf", "--outdir", docx_dir, *docx_paths],
+        check=True,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+
+
+def _unlink_quietly(path: str) -> None:
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+# ---------- ROW → DOCX WORKER ----------
+
+def _render_row_docx(row: dict, template_bytes: bytes, selected_date, work_dir: str, idx: int) -> str:
+    """
+    Render a single row's DOCX into work_dir and return its path.
+    Safe to call from a worker thread: idx keeps the filename unique so
+    two rows for the same site never write the same file concurrently.
+    """
+    site_slug = row.get("site_slug", "Site") or "Site"
+    docx_path = os.path.join(work_dir, f"{selected_date}_{site_slug}_{idx}.docx")
+
+    render_docx_for_row(row, template_bytes, out_path=docx_path)
+    return docx_path
+
+
 # ---------- STREAMLIT APP ----------
 
 def main():
@@ -199,19 +388,33 @@ def main():
         if not sheet_input:
             st.error("Please enter Google Sheet URL or ID.")
         else:
-            try:
-                df = load_sheet_via_csv(sheet_input, gid if gid else None)
-
-                if "Date" not in df.columns:
-                    st.error("Column 'Date' not found in sheet.")
-                else:
-                    # Parse Date column once and store in session
-                    df["Date_parsed"] = pd.to_datetime(df["Date"], errors="coerce")
-                    st.session_state["df"] = df
-                    st.success("✅ Data loaded successfully.")
-            except Exception as e:
-                st.error("Failed fetching sheet:")
-                st.exception(e)
+            # Skip the refetch when the same sheet is already in session
+            sheet_key = (extract_sheet_id(sheet_input), gid if gid else None)
+            if st.session_state.get("sheet_key") == sheet_key:
+                st.success("✅ Data already loaded for this sheet.")
+            else:
+                try:
+                    df = load_sheet_via_csv(sheet_input, gid if gid else None)
+
+                    if "Date" not in df.columns:
+                        st.error("Column 'Date' not found in sheet.")
+                    else:
+                        # Parse Date column once and store in session.
+                        # Google Form dates arrive as dd/mm/yyyy; an explicit
+                        # format skips pandas' per-value format inference.
+                        df["Date_parsed"] = pd.to_datetime(
+                            df["Date"], errors="coerce", format="%d/%m/%Y", cache=True
+                        )
+                        if df["Date_parsed"].isna().all():
+                            # Sheet uses some other date format — fall back
+                            # to inference rather than dropping every row
+                            df["Date_parsed"] = pd.to_datetime(df["Date"], errors="coerce")
+                        st.session_state["df"] = df
+                        st.session_state["sheet_key"] = sheet_key
+                        st.success("✅ Data loaded successfully.")
+                except Exception as e:
+                    st.error("Failed fetching sheet:")
+                    st.exception(e)
 
     # Main content: only show if df is loaded
     if "df" not in st.session_state:
@@ -237,7 +440,8 @@ def main():
         max_value=valid_dates[-1]
     )
 
-    df_date = df[df["Date_parsed"].dt.date == selected_date]
+    # Cells are already plain "" strings from the loader, so no NaN pass
+    df_date = add_site_name_columns(df[df["Date_parsed"].dt.date == selected_date].copy())
 
     st.subheader(f"Records for {selected_date}")
     if df_date.empty:
@@ -251,56 +455,67 @@ def main():
         st.error("❌ template.docx not found in project folder.")
         return
 
+    # DOCX output skips the Word/soffice conversion step entirely
+    fmt = st.radio("Output format", ["PDF", "DOCX"], horizontal=True)
+
     if st.button("Generate Report"):
+        # Each run writes a fresh temp ZIP; drop the previous run's file
+        # now rather than waiting for a process exit that may never come
+        prev_zip = st.session_state.pop("zip_path", None)
+        if prev_zip:
+            _unlink_quietly(prev_zip)
         try:
-            zip_buffer = BytesIO()
-            with zipfile.ZipFile(zip_buffer, "w", zipfile.ZIP_DEFLATED) as zipf:
-                for idx, row in df_date.iterrows():
-
-                    # 1. Generate DOCX in memory
-                    docx_buf = render_docx_for_row(row, template_path)
-
-                    # 2. Save temporary DOCX
-                    with tempfile.NamedTemporaryFile(delete=False, suffix=".docx") as tmp_docx:
-                        tmp_docx.write(docx_buf.getvalue())
-                        tmp_docx_path = tmp_docx.name
-
-                    # 3. Convert DOCX → PDF
-                    tmp_pdf_path = tmp_docx_path.replace(".docx", ".pdf")
-                    convert(tmp_docx_path, tmp_pdf_path)
-
-                    # 4. Load PDF bytes
-                    with open(tmp_pdf_path, "rb") as pdf_file:
-                        pdf_bytes = pdf_file.read()
-
-                    # 5. Build filename
-                    zone, unit_code, sitename = parse_site_name(row.get("Site Name", "Site"))
-                    site_slug = (sitename or "Site").replace(" ", "_")
-                    time_val = str(row.get("Time", "")).strip()
-                    time_slug = time_val.replace(":", "").replace(" ", "_") if time_val else str(idx)
-
-                    filename = f"{selected_date}_{site_slug}.pdf"
-
-                    # 6. Add to ZIP
-                    zipf.writestr(filename, pdf_bytes)
-
-                    # 7. Cleanup temp files
-                    try:
-                        os.remove(tmp_docx_path)
-                    except OSError:
-                        pass
-                    try:
-                        os.remove(tmp_pdf_path)
-                    except OSError:
-                        pass
-
-            zip_buffer.seek(0)
-            st.download_button(
-                "⬇️ Download ZIP (PDF)",
-                data=zip_buffer,
-                file_name=f"night_checks_{selected_date}.zip",
-                mime="application/zip"
-            )
+            # Read the template once; every row re-parses from these bytes
+            # instead of re-opening the file on disk.
+            template_bytes = Path(template_path).read_bytes()
+
+            work_dir = tempfile.mkdtemp()
+            try:
+                # Plain dicts are much cheaper to iterate than per-row Series
+                records = df_date.rename(columns=COLUMN_MAP).to_dict(orient="records")
+
+                # Render all DOCX files in parallel (rows are independent)
+                with ThreadPoolExecutor(max_workers=os.cpu_count() or 2) as ex:
+                    futures = [
+                        ex.submit(_render_row_docx, row, template_bytes, selected_date, work_dir, idx)
+                        for idx, row in enumerate(records)
+                    ]
+                    for fut in as_completed(futures):
+                        fut.result()
+
+                if fmt == "PDF":
+                    # One Word/soffice session converts the whole batch
+                    convert_batch(work_dir)
+
+                out_ext = ".pdf" if fmt == "PDF" else ".docx"
+
+                # Assemble the ZIP on disk behind a large write buffer so
+                # deflate's many small writes don't each hit the file.
+                with tempfile.NamedTemporaryFile(suffix=".zip", delete=False) as tmp_zip:
+                    zip_path = tmp_zip.name
+                with open(zip_path, "wb", buffering=2 * 1024 * 1024) as zip_out:
+                    # PDFs and DOCX are already deflate-compressed internally,
+                    # so store them as-is instead of burning CPU re-deflating.
+                    with zipfile.ZipFile(zip_out, "w", zipfile.ZIP_STORED) as zipf:
+                        for out_name in sorted(os.listdir(work_dir)):
+                            if out_name.endswith(out_ext):
+                                zipf.write(os.path.join(work_dir, out_name), arcname=out_name)
+            finally:
+                shutil.rmtree(work_dir, ignore_errors=True)
+
+            # The archive lives on disk, so memory stays constant no matter
+            # the batch size. The next run unlinks it via session state;
+            # atexit is only the backstop for the final file.
+            st.session_state["zip_path"] = zip_path
+            atexit.register(_unlink_quietly, zip_path)
+
+            with open(zip_path, "rb") as zip_file:
+                st.download_button(
+                    f"⬇️ Download ZIP ({fmt})",
+                    data=zip_file,
+                    file_name=f"night_checks_{selected_date}.zip",
+                    mime="application/zip"
+                )
         except Exception as e:
             st.error("Error generating PDF ZIP:")
             st.exception(e)